@@ -1,10 +1,12 @@
 # app.py
-from fastapi import FastAPI, Request
+from fastapi import BackgroundTasks, FastAPI, Request
 from fastapi.responses import JSONResponse, PlainTextResponse
-from urllib.parse import parse_qs
+from urllib.parse import parse_qsl
 from pathlib import Path
 from dotenv import load_dotenv
-import os, time, json, requests
+from requests.adapters import HTTPAdapter
+from contextlib import asynccontextmanager, suppress
+import os, time, asyncio, threading, orjson, requests
 
 # =============== CONFIG ===============
 # carrega o .env na mesma pasta do app.py
@@ -16,20 +18,48 @@ APP_SECRET = os.getenv("SEATALK_APP_SECRET")
 BOT_ID     = os.getenv("SEATALK_BOT_ID")
 TOKEN_URL  = os.getenv("SEATALK_TOKEN_URL") or f"{API_BASE}/auth/app_access_token"  # endpoint correto
 
-app = FastAPI()
+@asynccontextmanager
+async def lifespan(_app: FastAPI):
+    # renova o token em background antes de expirar (evita bloquear a DM no refresh)
+    task = asyncio.create_task(_token_refresher()) if APP_ID and APP_SECRET else None
+    try:
+        yield
+    finally:
+        if task:
+            task.cancel()
+            with suppress(asyncio.CancelledError):
+                await task
+
+app = FastAPI(lifespan=lifespan)
 _token_cache = {"value": None, "exp": 0.0}
+_token_lock = threading.Lock()
+
+# sessão HTTP única: reaproveita conexões keep-alive (evita handshake TLS a cada DM)
+_HTTP = requests.Session()
+_HTTP.mount(API_BASE, HTTPAdapter(pool_connections=4, pool_maxsize=16))
+_HTTP.headers.update({"Connection": "keep-alive"})
 
 # =============== TOKEN ===============
-def get_app_token() -> str:
-    """Busca (e cacheia) o app_access_token."""
+def get_app_token(min_ttl: float = 60) -> str:
+    """Busca (e cacheia) o app_access_token. Renova se faltar menos de min_ttl segundos."""
+    # caminho rápido sem lock
     now = time.time()
-    if _token_cache["value"] and (_token_cache["exp"] - now) > 60:
+    if _token_cache["value"] and (_token_cache["exp"] - now) > min_ttl:
         return _token_cache["value"]
 
     if not APP_ID or not APP_SECRET:
         raise RuntimeError("APP_ID/APP_SECRET não configurados")
 
-    r = requests.post(
+    with _token_lock:
+        # outro thread pode ter renovado enquanto esperávamos o lock
+        now = time.time()
+        if _token_cache["value"] and (_token_cache["exp"] - now) > min_ttl:
+            return _token_cache["value"]
+        return _fetch_app_token(now)
+
+def _fetch_app_token(now: float) -> str:
+    """Faz o POST do token e atualiza o cache (chamar com _token_lock)."""
+    r = _HTTP.post(
         TOKEN_URL,
         json={"app_id": APP_ID, "app_secret": APP_SECRET},
         headers={"Content-Type": "application/json"},
@@ -40,7 +70,7 @@ def get_app_token() -> str:
     if r.status_code != 200 or "application/json" not in ct:
         raise RuntimeError(f"Falha ao obter token: status={r.status_code} body={r.text[:200]}")
 
-    data = r.json()
+    data = orjson.loads(r.content)
     tok = data.get("app_access_token") or data.get("access_token")
     exp = int(data.get("expire") or data.get("expires_in") or 3600)
     if not tok:
@@ -49,6 +79,17 @@ def get_app_token() -> str:
     _token_cache["exp"] = now + exp
     return tok
 
+async def _token_refresher() -> None:
+    """Renova o token ~5 min antes de expirar."""
+    while True:
+        try:
+            await asyncio.to_thread(get_app_token, 300)
+            delay = max(_token_cache["exp"] - time.time() - 300, 30)
+        except Exception as e:
+            print("TOKEN REFRESH ERROR:", repr(e))
+            delay = 60
+        await asyncio.sleep(delay)
+
 # =============== ENVIAR DM ===============
 def send_text_dm(employee_code: str, text: str) -> bool:
     """
@@ -63,53 +104,88 @@ def send_text_dm(employee_code: str, text: str) -> bool:
         "message": {"tag": "text", "text": {"content": text}},
     }
     headers = {"Authorization": f"Bearer {token}", "Content-Type": "application/json"}
-    r = requests.post(url, json=payload, headers=headers, timeout=10)
+    r = _HTTP.post(url, json=payload, headers=headers, timeout=10)
     print("SEND RESP:", r.status_code, r.text[:200])
     return r.status_code == 200
 
+# =============== COMANDOS ===============
+def _h_ping(employee_code: str, args: str) -> None:
+    send_text_dm(employee_code, "pong")
+
+# comando (primeira palavra, minúscula) -> handler(employee_code, args)
+_HANDLERS = {
+    "ping": _h_ping,
+}
+
+def handle_command(employee_code: str, text_in: str) -> None:
+    """Processa o comando recebido (roda fora do event loop, em background)."""
+    parts = text_in.split(None, 1)
+    if not parts:
+        return
+    handler = _HANDLERS.get(parts[0])
+    if handler is None:
+        return
+    args = parts[1].strip() if len(parts) > 1 else ""
+    try:
+        handler(employee_code, args)
+    except Exception as e:
+        print("COMMAND ERROR:", repr(e))
+
 # =============== WEBHOOK / EVENTOS ===============
+def _get_challenge(payload):
+    """Extrai o seatalk_challenge do payload (raiz ou dentro de event)."""
+    if not isinstance(payload, dict):
+        return None
+    challenge = payload.get("seatalk_challenge") or payload.get("challenge")
+    if not challenge and isinstance(payload.get("event"), dict):
+        challenge = payload["event"].get("seatalk_challenge") or payload["event"].get("challenge")
+    return challenge
+
 @app.post("/seatalk/events")
-async def seatalk_events(request: Request):
-    # Lê o corpo independente do Content-Type
-    ct = (request.headers.get("content-type") or "").lower()
+async def seatalk_events(request: Request, background_tasks: BackgroundTasks):
     raw = await request.body()
-    body_text = raw.decode("utf-8", errors="ignore")
-    payload = {}
+    ct = (request.headers.get("content-type") or "").lower()
+
+    # tenta o orjson direto nos bytes; se não for JSON, cai no form-urlencoded
+    is_json = False
     try:
-        if "application/json" in ct and body_text.strip():
-            payload = json.loads(body_text)
-        elif "application/x-www-form-urlencoded" in ct:
-            payload = {k: v[0] for k, v in parse_qs(body_text).items()}
-        elif "multipart/form-data" in ct:
-            form = await request.form()
-            payload = dict(form)
-    except Exception:
+        payload = orjson.loads(raw)
+        is_json = True
+    except orjson.JSONDecodeError:
         payload = {}
+        if "application/x-www-form-urlencoded" in ct:
+            body_text = raw.decode("utf-8", errors="ignore")
+            for k, v in parse_qsl(body_text):
+                payload.setdefault(k, v)  # mantém o primeiro valor, como o parse_qs fazia
 
-    # Handshake (event_verification): responder com seatalk_challenge
-    challenge = None
-    if isinstance(payload, dict):
-        challenge = payload.get("seatalk_challenge") or payload.get("challenge")
-        if not challenge and isinstance(payload.get("event"), dict):
-            challenge = payload["event"].get("seatalk_challenge") or payload["event"].get("challenge")
+    # Handshake (event_verification): responde antes de qualquer outra checagem
+    challenge = _get_challenge(payload)
     if challenge:
         return JSONResponse({"seatalk_challenge": str(challenge)})
 
+    # eventos em JSON só são aceitos com Content-Type application/json
+    if not isinstance(payload, dict) or (is_json and "application/json" not in ct):
+        return PlainTextResponse("ok")
+
     # Eventos normais
     evt_type = payload.get("event_type")
-    evt = payload.get("event", {}) if isinstance(payload, dict) else {}
+    evt = payload.get("event") or {}
+    if not isinstance(evt, dict):
+        return PlainTextResponse("ok")
     if evt_type and evt_type != "event_verification":
         # normalmente vem seatalk_id e employee_code no event
         seatalk_id = evt.get("seatalk_id")
         employee_code = evt.get("employee_code")
         msg = evt.get("message") or {}
-        text_in = ((msg.get("text") or {}).get("content") or "").strip().lower()
+        text = (msg.get("text") or {}) if isinstance(msg, dict) else None
+        if not isinstance(text, dict):
+            return PlainTextResponse("ok")
+        content = text.get("content") or ""
+        text_in = content.strip().lower() if isinstance(content, str) else ""
         print("INCOMING:", {"seatalk_id": seatalk_id, "employee_code": employee_code, "text": text_in, "evt_type": evt_type})
 
-        if employee_code and text_in == "ping":
-            try:
-                send_text_dm(employee_code, "pong")
-            except Exception as e:
-                print("SEND ERROR:", repr(e))
+        # responde "ok" na hora; o envio da DM (I/O bloqueante) roda no threadpool
+        if employee_code and text_in:
+            background_tasks.add_task(handle_command, employee_code, text_in)
 
     return PlainTextResponse("ok")